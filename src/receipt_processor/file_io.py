@@ -1,21 +1,48 @@
 # file_io.py
 """File I/O utilities for reading and encoding files."""
 
+import io
 import os
 import base64
 
 
+# Read size for streaming encodes; must be a multiple of 3 so each chunk
+# encodes to base64 without padding
+CHUNK_SIZE = 57 * 1024
+
+
 def encode_file(path):
-    """Read a file and encode its contents as a base64 string.
+    """Read a file and encode its contents as base64.
+
+    Args:
+        path: The file path to read and encode.
+
+    Returns:
+        The base64-encoded file contents as ASCII bytes.
+    """
+    return encode_file_buffered(path)
+
+
+def encode_file_buffered(path, bufsize=CHUNK_SIZE):
+    """Encode a file as base64, reading it in fixed-size chunks.
+
+    Only one chunk of the raw file is held in memory at a time, instead of
+    the whole file alongside its encoded copy.
 
     Args:
         path: The file path to read and encode.
+        bufsize: Number of bytes to read per chunk. Rounded down to a
+            multiple of 3.
 
     Returns:
-        A base64-encoded string representation of the file contents.
+        The base64-encoded file contents as ASCII bytes.
     """
+    bufsize = max(3, bufsize - bufsize % 3)
+    buf = io.BytesIO()
     with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        while chunk := f.read(bufsize):
+            buf.write(base64.b64encode(chunk))
+    return buf.getvalue()
 
 
 def list_files(dirpath):
@@ -27,8 +54,8 @@ def list_files(dirpath):
     Yields:
         A tuple of (filename, filepath) for each file in the directory.
     """
-    for name in os.listdir(dirpath):
-        path = os.path.join(dirpath, name)
-        if os.path.isfile(path):
-            yield name, path
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.name, entry.path
 
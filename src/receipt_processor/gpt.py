@@ -1,23 +1,357 @@
 # gpt.py
 """OpenAI GPT integration for receipt information extraction."""
 
-import json
-from openai import OpenAI
+import io
+import os
+import sys
+import dbm
+import time
+import pickle
+import atexit
+import shelve
+import asyncio
+import hashlib
+import threading
 
-client = OpenAI()
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import httpx
+import orjson
+from openai import (OpenAI, AsyncOpenAI, DefaultHttpxClient,
+                    DefaultAsyncHttpxClient)
+
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 60
+
+# Sized above main.MAX_CONCURRENT_REQUESTS, with every connection kept alive
+# so concurrent requests reuse connections instead of reconnecting
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+
+client = OpenAI(
+    max_retries=MAX_RETRIES,
+    timeout=REQUEST_TIMEOUT,
+    http_client=DefaultHttpxClient(limits=HTTP_LIMITS)
+)
+
+# Default model; any vision-capable chat model can be passed instead, including
+# one served by an OpenAI-compatible server set through OPENAI_BASE_URL
+MODEL = "gpt-4.1-mini"
+SEED = 43
+
+# JSON mode: the API guarantees the reply parses as a JSON object
+RESPONSE_FORMAT = {"type": "json_object"}
+
+# Bump whenever the prompt changes so stale cached responses are ignored
+PROMPT_VERSION = "v6"
+
+CACHE_PATH = os.path.expanduser("~/.cache/receipts/responses")
+
+# Opened on first use and kept open for the rest of the run; the lock makes
+# it safe to use from the worker threads the async functions offload to
+_cache = None
+_cache_lock = threading.Lock()
+
+# Set by disable_cache() or after any cache failure; every lookup then misses
+_cache_disabled = False
+
+# Errors from opening, reading or writing the cache; all are treated as misses
+_CACHE_ERRORS = (*dbm.error, EOFError, pickle.PickleError)
+
+# Seconds to wait between polls of a pending batch job
+BATCH_POLL_INTERVAL = 30
+
+# Limits for one batch input file; the API accepts up to 200 MB and 50,000
+# requests per file, and the size limit leaves room for upload overhead
+BATCH_MAX_BYTES = 180 * 1000 * 1000
+BATCH_MAX_REQUESTS = 50_000
 
 CATEGORIES = ["Meals", "Transport", "Lodging", "Office Supplies",
 "Entertainment", "Other"]
 
+# Built once at import so every request sends identical prompt text
+PROMPT = f"""
+You are an information extraction system.
+Extract ONLY the following fields from the receipt image:
+
+date: the receipt date as a string
+amount: the total amount paid as it appears on the receipt
+vendor: the merchant or vendor name
+category: one of [{", ".join(CATEGORIES)}]
+
+Each receipt is described by an object with these four keys.
+If a field cannot be determined, use null.
+"""
+
+# Output instructions, sent after PROMPT so the shared prefix is unchanged
+SINGLE_RECEIPT_PROMPT = """
+This request contains one receipt image. Return its four-key object as the
+whole JSON reply.
+"""
+
+MULTI_RECEIPT_PROMPT = """
+This request contains several receipt images, each preceded by a label such
+as "Receipt 1:". Return one JSON object whose keys are the receipt numbers
+as strings ("1", "2", ...) and whose values are the four-key objects
+described above, one per receipt.
+"""
+
+
+def make_async_client():
+    """Create an async OpenAI client with the same settings as client.
+
+    Its connection pool is bound to the event loop that first uses it, so
+    create one per asyncio.run() and close it before the loop ends, e.g.
+    with "async with make_async_client() as async_client:".
+
+    Returns:
+        A new AsyncOpenAI client.
+    """
+    return AsyncOpenAI(
+        max_retries=MAX_RETRIES,
+        timeout=REQUEST_TIMEOUT,
+        http_client=DefaultAsyncHttpxClient(limits=HTTP_LIMITS)
+    )
+
+
+def _build_messages(image_b64):
+    """Build the chat messages for a receipt extraction request.
 
-def extract_receipt_info(image_b64):
-    """Extract structured information from a receipt image using GPT-4.1-mini.
+    The text parts are kept before the image so every request shares the
+    same prefix. OpenAI's automatic prompt caching only applies to prefixes
+    of 1024 tokens or more, so this matters once the prompt grows that long.
+
+    Args:
+        image_b64: The base64-encoded receipt image as bytes.
+
+    Returns:
+        A list of chat messages containing the prompt and the image.
+    """
+    # The SDK needs a str; decode once after joining the prefix as bytes
+    image_url = (b"data:image/jpeg;base64," + image_b64).decode("ascii")
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": PROMPT},
+                {"type": "text", "text": SINGLE_RECEIPT_PROMPT},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url
+                    }
+                }
+            ]
+        }
+    ]
+
+
+def _build_multi_messages(images_b64):
+    """Build the chat messages for a request covering several receipts.
+
+    Args:
+        images_b64: A list of base64-encoded receipt images as bytes.
+
+    Returns:
+        A list of chat messages containing the prompt and each labelled
+        image.
+    """
+    content = [
+        {"type": "text", "text": PROMPT},
+        {"type": "text", "text": MULTI_RECEIPT_PROMPT}
+    ]
+    for i, image_b64 in enumerate(images_b64, 1):
+        image_url = (b"data:image/jpeg;base64," + image_b64).decode("ascii")
+        content.append({"type": "text", "text": f"Receipt {i}:"})
+        content.append({"type": "image_url", "image_url": {"url": image_url}})
+    return [{"role": "user", "content": content}]
+
+
+def _parse_multi_response(pending, response):
+    """Match a multi-receipt response back to its receipts.
+
+    Args:
+        pending: The list of (name, image_b64) pairs that were sent.
+        response: The chat completion returned for the request.
+
+    Returns:
+        A tuple (results, missing) where results maps names to receipt data
+        and missing lists the (name, image_b64) pairs the model skipped, or
+        all of pending if the reply could not be parsed.
+    """
+    try:
+        parsed = orjson.loads(response.choices[0].message.content)
+    except orjson.JSONDecodeError:
+        # A truncated or garbled reply; retry every receipt on its own
+        return {}, list(pending)
+    results = {}
+    missing = []
+    for i, (name, image_b64) in enumerate(pending, 1):
+        data = parsed.get(str(i)) if isinstance(parsed, dict) else None
+        if isinstance(data, dict):
+            results[name] = data
+        else:
+            missing.append((name, image_b64))
+    return results, missing
+
+
+def _cache_key(image_b64, model):
+    """Build the response cache key for an image.
+
+    Args:
+        image_b64: The base64-encoded receipt image as bytes.
+        model: The model name the response came from.
+
+    Returns:
+        A key identifying the image, model, and prompt version.
+    """
+    digest = hashlib.sha256(image_b64).hexdigest()
+    return f"{model}:{PROMPT_VERSION}:{digest}"
+
+
+def disable_cache():
+    """Stop reading from and writing to the response cache for this run."""
+    global _cache_disabled
+    _cache_disabled = True
+
+
+def _cache_failed(error):
+    """Report a cache error and disable the cache for the rest of the run.
+
+    Must be called with _cache_lock held.
+
+    Args:
+        error: The exception raised by the cache.
+    """
+    global _cache_disabled
+    if not _cache_disabled:
+        print(f"Response cache unavailable, continuing without it: {error}",
+              file=sys.stderr)
+    _cache_disabled = True
+
+
+def _open_cache():
+    """Return the response cache, opening it on first use.
+
+    An exclusive lock file keeps a second process from opening the same
+    store at the same time; that process runs without the cache instead.
+    Must be called with _cache_lock held.
+
+    Returns:
+        The open shelf, or None if the cache is disabled or unavailable.
+    """
+    global _cache
+    if _cache_disabled:
+        return None
+    if _cache is None:
+        try:
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+            lock_file = open(CACHE_PATH + ".lock", "a")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    raise OSError("in use by another process") from None
+            _cache = shelve.open(CACHE_PATH)
+        except _CACHE_ERRORS as error:
+            _cache_failed(error)
+            return None
+        atexit.register(lock_file.close)
+        atexit.register(_cache.close)
+    return _cache
+
+
+def cache_get(image_b64, model=MODEL):
+    """Look up a previously extracted result for an image.
+
+    Args:
+        image_b64: The base64-encoded receipt image as bytes.
+        model: The model name the response came from.
+
+    Returns:
+        A copy of the cached receipt data, or None on a cache miss or if
+        the cache cannot be read.
+    """
+    with _cache_lock:
+        cache = _open_cache()
+        if cache is None:
+            return None
+        try:
+            data = cache.get(_cache_key(image_b64, model))
+        except _CACHE_ERRORS as error:
+            _cache_failed(error)
+            return None
+    return dict(data) if data is not None else None
+
+
+def cache_put(image_b64, data, model=MODEL):
+    """Store an extracted result for an image.
+
+    Does nothing if the cache is disabled or cannot be written.
+
+    Args:
+        image_b64: The base64-encoded receipt image as bytes.
+        data: The receipt data returned by the model.
+        model: The model name the response came from.
+    """
+    with _cache_lock:
+        cache = _open_cache()
+        if cache is None:
+            return
+        try:
+            cache[_cache_key(image_b64, model)] = data
+        except _CACHE_ERRORS as error:
+            _cache_failed(error)
+
+
+def _split_cached(images_b64, model):
+    """Separate cached receipts from those that still need a request.
+
+    Args:
+        images_b64: A list of (name, image_b64) pairs.
+        model: The model name the responses came from.
+
+    Returns:
+        A tuple (results, pending) where results maps names to cached
+        receipt data and pending lists the uncached (name, image_b64) pairs.
+    """
+    results = {}
+    pending = []
+    for name, image_b64 in images_b64:
+        cached = cache_get(image_b64, model)
+        if cached is not None:
+            results[name] = cached
+        else:
+            pending.append((name, image_b64))
+    return results, pending
+
+
+def _cache_matched(pending, matched, model):
+    """Store the receipts of a multi-receipt response that were matched.
+
+    Args:
+        pending: The list of (name, image_b64) pairs that were sent.
+        matched: A dictionary mapping names to receipt data.
+        model: The model name the responses came from.
+    """
+    for name, image_b64 in pending:
+        if name in matched:
+            cache_put(image_b64, matched[name], model)
+
+
+def extract_receipt_info(image_b64, model=MODEL):
+    """Extract structured information from a receipt image using GPT.
 
     Sends the base64-encoded image to OpenAI's API and requests extraction
-    of date, amount, vendor, and category fields.
+    of date, amount, vendor, and category fields. Results are cached on disk
+    so the same image is only sent once.
 
     Args:
-        image_b64: A base64-encoded string of the receipt image.
+        image_b64: The base64-encoded receipt image as bytes.
+        model: The OpenAI model to use.
 
     Returns:
         A dictionary containing the extracted fields:
@@ -27,39 +361,282 @@ def extract_receipt_info(image_b64):
             - category: One of the predefined categories (Meals, Transport,
               Lodging, Office Supplies, Entertainment, Other).
     """
-    prompt = f"""
-You are an information extraction system.
-Extract ONLY the following fields from the receipt image:
+    cached = cache_get(image_b64, model)
+    if cached is not None:
+        return cached
 
-date: the receipt date as a string
-amount: the total amount paid as it appears on the receipt
-vendor: the merchant or vendor name
-category: one of [{", ".join(CATEGORIES)}]
+    response = client.chat.completions.create(
+        model=model,
+        seed=SEED,
+        response_format=RESPONSE_FORMAT,
+        messages=_build_messages(image_b64)
+    )
+    data = orjson.loads(response.choices[0].message.content)
+    cache_put(image_b64, data, model)
+    return dict(data)
 
-Return EXACTLY one JSON object with these four keys and NOTHING ELSE.
-Do not include explanations, comments, or formatting.
-Do not wrap the JSON in markdown.
-If a field cannot be determined, use null.
 
-The output must be valid JSON.
-"""
-    response = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        seed=43,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_b64}"
-                        }
-                    }
-                ]
-            }
-        ]
+async def extract_receipt_info_async(image_b64, async_client, model=MODEL):
+    """Asynchronously extract structured information from a receipt image.
+
+    Same as extract_receipt_info, but uses the async client so that many
+    receipts can be in flight at the same time. Cache reads and writes run
+    on a worker thread so they do not block the event loop.
+
+    Args:
+        image_b64: The base64-encoded receipt image as bytes.
+        async_client: The client from make_async_client to send it with.
+        model: The OpenAI model to use.
+
+    Returns:
+        A dictionary containing the extracted date, amount, vendor, and
+        category fields.
+    """
+    cached = await asyncio.to_thread(cache_get, image_b64, model)
+    if cached is not None:
+        return cached
+
+    response = await async_client.chat.completions.create(
+        model=model,
+        seed=SEED,
+        response_format=RESPONSE_FORMAT,
+        messages=_build_messages(image_b64)
+    )
+    data = orjson.loads(response.choices[0].message.content)
+    await asyncio.to_thread(cache_put, image_b64, data, model)
+    return dict(data)
+
+
+def extract_receipt_info_batch(images_b64, model=MODEL):
+    """Extract information from several receipt images in one request.
+
+    Sending a few receipts together saves a request per receipt and shares
+    the prompt tokens between them. Cached receipts are not resent, and any
+    receipt missing from the model's answer is retried on its own.
+
+    Args:
+        images_b64: A list of (name, image_b64) pairs, where image_b64 is
+            the base64-encoded receipt image as bytes.
+        model: The OpenAI model to use.
+
+    Returns:
+        A dictionary mapping each name to its extracted receipt data.
+    """
+    results, pending = _split_cached(images_b64, model)
+
+    if len(pending) > 1:
+        response = client.chat.completions.create(
+            model=model,
+            seed=SEED,
+            response_format=RESPONSE_FORMAT,
+            messages=_build_multi_messages([b64 for _, b64 in pending])
+        )
+        matched, missing = _parse_multi_response(pending, response)
+        _cache_matched(pending, matched, model)
+        results.update(matched)
+        pending = missing
+
+    for name, image_b64 in pending:
+        results[name] = extract_receipt_info(image_b64, model)
+    return results
+
+
+async def extract_receipt_info_batch_async(images_b64, async_client,
+                                           model=MODEL):
+    """Asynchronously extract information from several receipt images.
+
+    Same as extract_receipt_info_batch, but uses the async client and runs
+    cache reads and writes on a worker thread.
+
+    Args:
+        images_b64: A list of (name, image_b64) pairs, where image_b64 is
+            the base64-encoded receipt image as bytes.
+        async_client: The client from make_async_client to send them with.
+        model: The OpenAI model to use.
+
+    Returns:
+        A dictionary mapping each name to its extracted receipt data.
+    """
+    results, pending = await asyncio.to_thread(_split_cached, images_b64,
+                                               model)
+
+    if len(pending) > 1:
+        response = await async_client.chat.completions.create(
+            model=model,
+            seed=SEED,
+            response_format=RESPONSE_FORMAT,
+            messages=_build_multi_messages([b64 for _, b64 in pending])
+        )
+        matched, missing = _parse_multi_response(pending, response)
+        await asyncio.to_thread(_cache_matched, pending, matched, model)
+        results.update(matched)
+        pending = missing
+
+    for name, image_b64 in pending:
+        results[name] = await extract_receipt_info_async(image_b64,
+                                                          async_client, model)
+    return results
+
+
+def _batch_request(name, image_b64, model):
+    """Build the JSONL line for one receipt in a batch input file.
+
+    Args:
+        name: The filename, used as the request's custom_id.
+        image_b64: The base64-encoded receipt image as bytes.
+        model: The OpenAI model to use.
+
+    Returns:
+        The request as a JSON line in bytes, without the trailing newline.
+    """
+    return orjson.dumps({
+        "custom_id": name,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "seed": SEED,
+            "response_format": RESPONSE_FORMAT,
+            "messages": _build_messages(image_b64)
+        }
+    })
+
+
+def _create_batch(lines):
+    """Upload a batch input file and create a batch job for it.
+
+    Args:
+        lines: The JSONL request lines as bytes.
+
+    Returns:
+        The ID of the created batch job.
+    """
+    batch_file = client.files.create(
+        file=("receipts.jsonl", io.BytesIO(b"\n".join(lines))),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
     )
-    return json.loads(response.choices[0].message.content)
+    return batch.id
+
+
+def submit_batches(images_b64, model=MODEL):
+    """Submit receipt images to the OpenAI Batch API.
+
+    Writes one request per image to JSONL input files, starting a new file
+    whenever the next request would take it past BATCH_MAX_BYTES or
+    BATCH_MAX_REQUESTS, and creates a batch job for each. Images are
+    consumed lazily, so only one input file is held in memory at a time.
+    Batch jobs are cheaper and not subject to per-minute rate limits, but
+    may take up to 24 hours to complete.
+
+    Args:
+        images_b64: An iterable of (filename, base64-encoded image bytes)
+            pairs.
+        model: The OpenAI model to use.
+
+    Yields:
+        A tuple (batch_id, names) for each batch job as it is created,
+        where names lists the filenames submitted in it.
+    """
+    lines = []
+    names = []
+    size = 0
+    for name, image_b64 in images_b64:
+        line = _batch_request(name, image_b64, model)
+        if lines and (len(lines) == BATCH_MAX_REQUESTS
+                      or size + len(line) + 1 > BATCH_MAX_BYTES):
+            yield _create_batch(lines), names
+            lines = []
+            names = []
+            size = 0
+        lines.append(line)
+        names.append(name)
+        size += len(line) + 1
+    if lines:
+        yield _create_batch(lines), names
+
+
+def _read_batch_file(file_id):
+    """Read the JSONL records of a batch output or error file.
+
+    Args:
+        file_id: The ID of the file, or None if the batch produced none.
+
+    Returns:
+        A list of the records in the file.
+    """
+    if file_id is None:
+        return []
+    content = client.files.content(file_id).text
+    return [orjson.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def _batch_record_error(record):
+    """Describe why a batch request failed.
+
+    Args:
+        record: A record from a batch output or error file.
+
+    Returns:
+        An error message, or None if the request succeeded.
+    """
+    if record.get("error"):
+        return record["error"].get("message", str(record["error"]))
+    response = record.get("response") or {}
+    if response.get("status_code") != 200:
+        body = response.get("body") or {}
+        error = body.get("error") or {}
+        return error.get("message",
+                         f"HTTP status {response.get('status_code')}")
+    return None
+
+
+def wait_for_batch(batch_id, names=()):
+    """Wait for a batch job to finish and collect its results.
+
+    Results are read for every final status, so an expired or cancelled
+    job still yields the requests it finished before it stopped.
+
+    Args:
+        batch_id: The ID of a batch job created by submit_batches.
+        names: The filenames submitted in the job, if known. Any of them
+            without a result is reported in errors.
+
+    Returns:
+        A tuple (results, errors) where results maps each filename to its
+        extracted receipt data and errors maps each filename whose request
+        failed to an error message.
+    """
+    batch = client.batches.retrieve(batch_id)
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch_id)
+
+    results = {}
+    errors = {}
+    records = (_read_batch_file(batch.output_file_id)
+               + _read_batch_file(batch.error_file_id))
+    for record in records:
+        name = record["custom_id"]
+        error = _batch_record_error(record)
+        if error is None:
+            content = record["response"]["body"]["choices"][0]["message"]["content"]
+            try:
+                results[name] = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                error = "response was not valid JSON"
+        if error is not None:
+            errors[name] = error
 
+    if batch.status == "completed":
+        unfinished = "no result returned by the batch"
+    else:
+        unfinished = f"batch {batch_id} {batch.status} before it finished"
+    for name in names:
+        if name not in results and name not in errors:
+            errors[name] = unfinished
+    return results, errors
@@ -1,17 +1,56 @@
 # main.py
 """Command-line interface for processing receipt images."""
 
+import re
+import sys
 import json
+import asyncio
 import argparse
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+
+import numpy as np
+
 from . import file_io as io_mod
 from . import gpt
 
+# Maximum number of GPT requests in flight at once
+MAX_CONCURRENT_REQUESTS = 20
+
+# Number of receipts sent to GPT in a single request
+RECEIPTS_PER_REQUEST = 4
+
+# Number of threads used to read and encode files
+MAX_ENCODE_WORKERS = 8
+
+# Number of groups encoded ahead of a free request slot; bounds how many
+# encoded images are held in memory at once
+READ_AHEAD_GROUPS = 2
+
+# Number of files encoded at a time while building batch input files
+BATCH_ENCODE_CHUNK = 64
+
+# Currency symbols and whitespace removed from amounts in a single pass
+_AMOUNT_STRIP = str.maketrans("", "", "$€£¥ \t\n\r")
+
+# Leading or trailing currency code or abbreviation, such as EUR or Rs.
+_CURRENCY_CODE = re.compile(r"^[A-Za-z][A-Za-z.]*|[A-Za-z][A-Za-z.]*$")
+
+# First group of digits before a thousands separator
+_LEADING_GROUP = re.compile(r"-?\d{1,3}")
+
 
 def sanitize_amount(amount):
     """Clean and convert the amount field to a float.
 
-    Removes currency symbols (like $) and converts the string to a float.
+    Removes currency symbols (like $ or €), currency codes (like EUR or
+    USD), and thousands separators, and converts the string to a float.
+    Both "1,234.56" and the European "1.234,56" are understood. A lone
+    separator followed by exactly three digits, as in "1,234" or "1.234",
+    is read as a thousands separator. Amounts whose separators do not form
+    groups of three digits are rejected rather than guessed at.
     This function handles inconsistent LLM output where amounts may include
     currency symbols or be returned as strings instead of numbers.
 
@@ -20,34 +59,213 @@ def sanitize_amount(amount):
 
     Returns:
         The amount as a float, or None if the amount is invalid or missing.
+        Every stored amount goes through this function, so downstream code
+        only needs to check for None.
+
+    Examples:
+        >>> sanitize_amount("$43.83")
+        43.83
+        >>> sanitize_amount("EUR 12,50")
+        12.5
+        >>> sanitize_amount("12.50 USD")
+        12.5
+        >>> sanitize_amount("CHF 5.00")
+        5.0
+        >>> sanitize_amount("1.234,56")
+        1234.56
+        >>> sanitize_amount("£1,234.56")
+        1234.56
+        >>> sanitize_amount("1,234")
+        1234.0
+        >>> sanitize_amount("EUR 1.234")
+        1234.0
+        >>> sanitize_amount("12.50.") is None
+        True
+        >>> sanitize_amount("1,23.45") is None
+        True
+        >>> sanitize_amount("n/a") is None
+        True
     """
     if amount is None:
         return None
-    # Remove $ symbol if present and convert to float
-    cleaned = str(amount).replace("$", "").strip()
+    cleaned = _CURRENCY_CODE.sub("", str(amount).translate(_AMOUNT_STRIP))
+
+    if "," in cleaned and "." in cleaned:
+        # Whichever separator comes last is the decimal point
+        if cleaned.rfind(",") > cleaned.rfind("."):
+            thousands, decimal = ".", ","
+        else:
+            thousands, decimal = ",", "."
+    elif "," in cleaned or "." in cleaned:
+        sep = "," if "," in cleaned else "."
+        parts = cleaned.split(sep)
+        if len(parts) == 2 and len(parts[1]) != 3:
+            thousands, decimal = None, sep
+        else:
+            thousands, decimal = sep, None
+    else:
+        thousands, decimal = None, None
+
+    whole, frac = cleaned, ""
+    if decimal is not None:
+        if cleaned.count(decimal) > 1:
+            return None
+        whole, frac = cleaned.split(decimal)
+        if frac and not frac.isdigit():
+            return None
+    if thousands is not None:
+        groups = whole.split(thousands)
+        if (not _LEADING_GROUP.fullmatch(groups[0])
+                or any(len(g) != 3 or not g.isdigit() for g in groups[1:])):
+            return None
+        whole = "".join(groups)
+
     try:
-        return float(cleaned)
+        return float(f"{whole}.{frac}" if frac else whole)
     except ValueError:
         return None
 
 
-def process_directory(dirpath):
+async def process_directory(dirpath, model=gpt.MODEL):
     """Process all receipt images in a directory and extract information.
 
+    Receipts are sent to GPT in groups of RECEIPTS_PER_REQUEST, with at most
+    MAX_CONCURRENT_REQUESTS requests in flight at once. Files are read and
+    encoded on a thread pool so disk I/O overlaps with pending requests,
+    but only READ_AHEAD_GROUPS groups ahead, so memory stays bounded.
+
+    Args:
+        dirpath: Path to the directory containing receipt images.
+        model: The OpenAI model to use.
+
+    Returns:
+        A dictionary mapping each filename to its extracted receipt data.
+    """
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    read_ahead = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS + READ_AHEAD_GROUPS)
+
+    async def process_group(executor, group):
+        # Held until the request finishes, so at most READ_AHEAD_GROUPS
+        # groups sit encoded while waiting for a request slot
+        async with read_ahead:
+            encoded = await asyncio.gather(
+                *(loop.run_in_executor(executor, io_mod.encode_file, path)
+                  for _, path in group)
+            )
+            images_b64 = [(name, image_b64)
+                          for (name, _), image_b64 in zip(group, encoded)]
+            async with sem:
+                results = await gpt.extract_receipt_info_batch_async(
+                    images_b64, async_client, model)
+        for data in results.values():
+            # Sanitize the amount field
+            data["amount"] = sanitize_amount(data.get("amount"))
+        return results
+
+    files = list(io_mod.list_files(dirpath))
+    groups = [files[i:i + RECEIPTS_PER_REQUEST]
+              for i in range(0, len(files), RECEIPTS_PER_REQUEST)]
+    # The client's connections belong to this event loop, so close them here
+    async with gpt.make_async_client() as async_client:
+        with ThreadPoolExecutor(max_workers=MAX_ENCODE_WORKERS) as executor:
+            group_results = await asyncio.gather(
+                *(process_group(executor, group) for group in groups)
+            )
+
+    results = {}
+    for group_result in group_results:
+        results.update(group_result)
+    # Keep the directory listing order
+    return {name: results[name] for name, _ in files}
+
+
+def _encode_files(executor, files):
+    """Read and encode files on a thread pool, BATCH_ENCODE_CHUNK at a time.
+
+    Args:
+        executor: The thread pool to encode on.
+        files: A list of (filename, path) pairs.
+
+    Yields:
+        A (filename, base64-encoded image bytes) pair for each file, in order.
+    """
+    for i in range(0, len(files), BATCH_ENCODE_CHUNK):
+        chunk = files[i:i + BATCH_ENCODE_CHUNK]
+        encoded = executor.map(io_mod.encode_file, [path for _, path in chunk])
+        yield from zip((name for name, _ in chunk), encoded)
+
+
+def process_directory_batch(dirpath, model=gpt.MODEL, batch_ids=None):
+    """Process all receipt images in a directory using the Batch API.
+
+    Slower than process_directory (results may take up to 24 hours) but
+    roughly half the cost, which suits large offline runs. Uncached
+    receipts are split across as many batch jobs as the API limits
+    require, and each job ID is printed to stderr as it is created so an
+    interrupted run can be resumed. Receipts whose requests fail are
+    reported on stderr and left out of the results.
+
     Args:
         dirpath: Path to the directory containing receipt images.
+        model: The OpenAI model to use. When resuming, this must match
+            the model the jobs were submitted with.
+        batch_ids: IDs of batch jobs from an earlier run to collect
+            results from instead of submitting new ones.
 
     Returns:
         A dictionary mapping each filename to its extracted receipt data.
     """
+    files = list(io_mod.list_files(dirpath))
+    paths = dict(files)
     results = {}
-    for name, path in io_mod.list_files(dirpath):
-        image_b64 = io_mod.encode_file(path)
-        data = gpt.extract_receipt_info(image_b64)
+
+    def uncached(executor):
+        for name, image_b64 in _encode_files(executor, files):
+            cached = gpt.cache_get(image_b64, model)
+            if cached is not None:
+                results[name] = cached
+            else:
+                yield name, image_b64
+
+    with ThreadPoolExecutor(max_workers=MAX_ENCODE_WORKERS) as executor:
+        if batch_ids:
+            pending = [name for name, _ in uncached(executor)]
+            batches = [(batch_id, ()) for batch_id in batch_ids]
+        else:
+            pending = []
+            batches = []
+            for batch_id, names in gpt.submit_batches(uncached(executor),
+                                                      model):
+                print(f"Submitted batch {batch_id} with {len(names)} "
+                      f"receipts", file=sys.stderr)
+                batches.append((batch_id, names))
+
+        batch_results = {}
+        errors = {}
+        for batch_id, names in batches:
+            found, failed = gpt.wait_for_batch(batch_id, names)
+            batch_results.update(found)
+            errors.update(failed)
+        for name in pending:
+            if name not in batch_results and name not in errors:
+                errors[name] = "no result in the resumed batches"
+
+        # Images are not kept between submission and the results, so read
+        # them again to compute their cache keys
+        done = [(name, paths[name]) for name in batch_results if name in paths]
+        for name, image_b64 in _encode_files(executor, done):
+            gpt.cache_put(image_b64, batch_results[name], model)
+            results[name] = dict(batch_results[name])
+
+    for name, error in sorted(errors.items()):
+        print(f"Skipping {name}: {error}", file=sys.stderr)
+
+    for data in results.values():
         # Sanitize the amount field
         data["amount"] = sanitize_amount(data.get("amount"))
-        results[name] = data
-    return results
+    # Keep the directory listing order
+    return {name: results[name] for name, _ in files if name in results}
 
 
 def parse_date(date_str):
@@ -59,19 +277,83 @@ def parse_date(date_str):
     Returns:
         A datetime object, or None if parsing fails.
     """
+    if not isinstance(date_str, str):
+        return None
+    return _parse_date(date_str)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(date_str):
+    """Parse a YYYY-MM-DD string, caching results.
+
+    Zero-padded dates are sliced directly, which is much faster than
+    strptime. Anything else, such as "2025-1-5", falls back to strptime.
+    """
+    if (len(date_str) == 10 and date_str[4] == "-" and date_str[7] == "-"
+            and date_str[0:4].isdigit() and date_str[5:7].isdigit()
+            and date_str[8:10].isdigit()):
+        try:
+            return datetime(int(date_str[0:4]), int(date_str[5:7]),
+                            int(date_str[8:10]))
+        except ValueError:
+            return None
     try:
         return datetime.strptime(date_str, "%Y-%m-%d")
-    except (ValueError, TypeError):
+    except ValueError:
         return None
 
 
-def calculate_expenses(data, start_date, end_date):
+ReceiptArrays = collections.namedtuple(
+    "ReceiptArrays", ["amounts", "dates", "codes", "categories"])
+
+
+def receipt_arrays(data, with_dates=True):
+    """Convert receipt data into NumPy arrays for vectorized queries.
+
+    Only receipts with a valid amount are included, since the others never
+    count towards any total. Build this once and pass it to
+    calculate_expenses and aggregate_by_category.
+
+    Args:
+        data: Dictionary mapping filenames to receipt data.
+        with_dates: Whether to parse receipt dates. Only calculate_expenses
+            needs them.
+
+    Returns:
+        A ReceiptArrays tuple where amounts is a float array, dates is a
+        datetime64[D] array (NaT for invalid dates) or None if with_dates is
+        False, codes is an integer array indexing into categories, and
+        categories lists each category in the order it first appears.
+    """
+    # sanitize_amount guarantees a float or None
+    receipts = [r for r in data.values() if r.get("amount") is not None]
+
+    amounts = np.fromiter((r["amount"] for r in receipts), dtype=np.float64,
+                          count=len(receipts))
+
+    dates = None
+    if with_dates:
+        dates = np.array([parse_date(r.get("date")) for r in receipts],
+                         dtype="datetime64[D]")
+
+    # Assigns each new category the next free code on first lookup
+    category_codes = collections.defaultdict(lambda: len(category_codes))
+    codes = np.fromiter(
+        (category_codes[r.get("category", "Other")] for r in receipts),
+        dtype=np.intp, count=len(receipts))
+
+    return ReceiptArrays(amounts, dates, codes, list(category_codes))
+
+
+def calculate_expenses(data, start_date, end_date, arrays=None):
     """Calculate total expenses within a date range.
 
     Args:
         data: Dictionary mapping filenames to receipt data.
         start_date: Start date string in YYYY-MM-DD format.
         end_date: End date string in YYYY-MM-DD format.
+        arrays: Optional ReceiptArrays for data. Rebuilt from data if not
+            given or built without dates.
 
     Returns:
         Total expenses as a float.
@@ -82,64 +364,57 @@ def calculate_expenses(data, start_date, end_date):
     if start is None or end is None:
         return 0.0
 
-    total = 0.0
-    for receipt in data.values():
-        receipt_date = parse_date(receipt.get("date"))
-        amount = receipt.get("amount")
+    if arrays is None or arrays.dates is None:
+        arrays = receipt_arrays(data)
 
-        # Skip if date is invalid or outside range
-        if receipt_date is None:
-            continue
-        if receipt_date < start or receipt_date > end:
-            continue
+    # Comparisons against NaT are always False, so invalid dates drop out
+    mask = ((arrays.dates >= np.datetime64(start, "D"))
+            & (arrays.dates <= np.datetime64(end, "D")))
+    return float(arrays.amounts[mask].sum())
 
-        # Skip if amount is invalid
-        if amount is None or not isinstance(amount, (int, float)):
-            continue
 
-        total += amount
-
-    return total
-
-
-def aggregate_by_category(data):
+def aggregate_by_category(data, arrays=None):
     """Aggregate expenses by category.
 
     Args:
         data: Dictionary mapping filenames to receipt data.
+        arrays: Optional ReceiptArrays for data. Built from data if not
+            given.
 
     Returns:
         A dictionary mapping category names to total amounts.
     """
-    totals = {}
-    for receipt in data.values():
-        category = receipt.get("category", "Other")
-        amount = receipt.get("amount")
-
-        if amount is None or not isinstance(amount, (int, float)):
-            continue
+    if arrays is None:
+        arrays = receipt_arrays(data, with_dates=False)
 
-        if category not in totals:
-            totals[category] = 0.0
-        totals[category] += amount
+    totals = np.bincount(arrays.codes, weights=arrays.amounts,
+                         minlength=len(arrays.categories))
+    return dict(zip(arrays.categories, totals.tolist()))
 
-    return totals
 
-
-def plot_expenses_by_category(data, output_path="expenses_by_category.png"):
+def plot_expenses_by_category(data, output_path="expenses_by_category.png",
+                              arrays=None):
     """Generate a pie chart of expenses by category.
 
     Args:
         data: Dictionary mapping filenames to receipt data.
         output_path: Path to save the pie chart image.
+        arrays: Optional ReceiptArrays for data, passed on to
+            aggregate_by_category.
+
+    Returns:
+        The path the chart was saved to, or None if there was no valid data
+        to plot.
     """
+    import matplotlib
+    # Render off-screen; the chart is only ever written to a file
+    matplotlib.use("Agg")
     import matplotlib.pyplot as plt
 
-    totals = aggregate_by_category(data)
+    totals = aggregate_by_category(data, arrays)
 
     if not totals:
-        print("No valid data to plot.")
-        return
+        return None
 
     categories = list(totals.keys())
     amounts = list(totals.values())
@@ -151,7 +426,7 @@ def plot_expenses_by_category(data, output_path="expenses_by_category.png"):
     plt.savefig(output_path)
     plt.close()
 
-    print(f"Pie chart saved to {output_path}")
+    return output_path
 
 
 def main():
@@ -163,6 +438,11 @@ def main():
         --expenses: If provided with start and end dates (YYYY-MM-DD),
             calculate total expenses within that date range.
         --plot: If provided, generate a pie chart of expenses by category.
+        --batch: If provided, process receipts through the OpenAI Batch API.
+        --resume-batch: IDs of batch jobs to collect results from instead
+            of submitting new ones; implies --batch.
+        --model: The OpenAI model to use (default: gpt-4.1-mini).
+        --no-cache: If provided, neither read nor write the response cache.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("dirpath")
@@ -171,19 +451,50 @@ def main():
                         help="Calculate expenses between START and END dates (YYYY-MM-DD)")
     parser.add_argument("--plot", action="store_true",
                         help="Generate a pie chart of expenses by category")
+    parser.add_argument("--batch", action="store_true",
+                        help="Process receipts with the Batch API (cheaper, slower)")
+    parser.add_argument("--resume-batch", action="append", metavar="BATCH_ID",
+                        help="Collect the results of a batch job from an "
+                             "earlier --batch run (repeatable)")
+    parser.add_argument("--model", default=gpt.MODEL,
+                        help=f"OpenAI model to use (default: {gpt.MODEL})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not read or write the response cache")
     args = parser.parse_args()
 
-    data = process_directory(args.dirpath)
-
-    if args.print:
-        print(json.dumps(data, indent=2))
-
-    if args.expenses:
-        total = calculate_expenses(data, args.expenses[0], args.expenses[1])
-        print(f"Total expenses from {args.expenses[0]} to {args.expenses[1]}: ${total:.2f}")
-
-    if args.plot:
-        plot_expenses_by_category(data)
+    if args.no_cache:
+        gpt.disable_cache()
+
+    if args.batch or args.resume_batch:
+        data = process_directory_batch(args.dirpath, args.model,
+                                       args.resume_batch)
+    else:
+        data = asyncio.run(process_directory(args.dirpath, args.model))
+
+    arrays = None
+    if args.expenses or args.plot:
+        arrays = receipt_arrays(data, with_dates=bool(args.expenses))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Draw the chart in the background while the other results print
+        if args.plot:
+            plot_future = executor.submit(plot_expenses_by_category, data,
+                                          arrays=arrays)
+
+        if args.print:
+            print(json.dumps(data, indent=2))
+
+        if args.expenses:
+            total = calculate_expenses(data, args.expenses[0], args.expenses[1],
+                                       arrays)
+            print(f"Total expenses from {args.expenses[0]} to {args.expenses[1]}: ${total:.2f}")
+
+        if args.plot:
+            output_path = plot_future.result()
+            if output_path is None:
+                print("No valid data to plot.")
+            else:
+                print(f"Pie chart saved to {output_path}")
 
 if __name__ == "__main__":
     main()